@@ -5,19 +5,61 @@ Tested on 20.6.4 / 20.9.4 / 20.12.4
 """
 from typing import Dict, List, Any, Tuple
 from dataclasses import dataclass
+from functools import cached_property, lru_cache
 import asyncio
+import contextvars
+import socket
+import struct
+from urllib.parse import urlencode
+from urllib.request import getproxies, proxy_bypass
 import httpx
-import json
+import orjson
 from ipaddress import IPv4Address, IPv4Network, AddressValueError
-import nest_asyncio
-nest_asyncio.apply()
+
+# Cached IPv4 parsing: the same addresses and subnets repeat across records
+@lru_cache(maxsize=4096)
+def _ip(address:str) -> IPv4Address:
+    return IPv4Address(address)
+
+# Packed IPv4 helpers: addresses are stored as int and converted on demand
+def _ip_int(address:str) -> int:
+    # inet_pton is strict, unlike inet_aton: no octal, short or trailing forms
+    try:
+        return struct.unpack(">I", socket.inet_pton(socket.AF_INET, address))[0]
+    except OSError:
+        raise AddressValueError(f"Invalid IPv4 address {address!r}") from None
+
+def _ip_str(address:int|None) -> str|None:
+    return socket.inet_ntoa(struct.pack(">I", address)) if address is not None else None
+
+# Dotted-quad netmask to (prefix length, packed mask), e.g. "255.255.255.0" -> (24, 0xFFFFFF00)
+def _netmasks() -> Dict[str,Tuple[int,int]]:
+    netmasks = {}
+    for prefix in range(33):
+        packed = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+        netmasks[_ip_str(packed)] = (prefix, packed)
+    return netmasks
+
+_NETMASKS = _netmasks()
+
+@lru_cache(maxsize=4096)
+def _net(address:str, mask:str) -> IPv4Network:
+    netmask = _NETMASKS.get(mask)
+    if netmask is None:
+        # Hostmasks and other unusual notations
+        return IPv4Network(f'{address}/{mask}', strict=False)
+    prefix, packed = netmask
+    return IPv4Network((_ip_int(address) & packed, prefix))
+
+# Shared semaphores whose permit the current task holds, so that nested get_all calls do not wait on them
+_held_sems:contextvars.ContextVar[frozenset] = contextvars.ContextVar("_held_sems", default=frozenset())
 
 # CLASS Device
-@dataclass
+@dataclass(slots=True)
 class DeviceData:
     uuid:str
     persona:str
-    system_ip:IPv4Address|None
+    system_ip:int|None
     hostname:str|None
     site_id:int|None
     model:str|None
@@ -32,8 +74,12 @@ class DeviceData:
     latitude:float=0
     longitude:float=0
 
+    @property
+    def system_ipv4(self) -> IPv4Address|None:
+        return IPv4Address(self.system_ip) if self.system_ip is not None else None
+
 # CLASS Interface
-@dataclass
+@dataclass(slots=True)
 class InterfaceData:
     if_name: str
     if_desc:str
@@ -45,74 +91,143 @@ class InterfaceData:
     raw_data:Dict
 
 # CLASS Virtual_IP
-@dataclass
+@dataclass(slots=True)
 class VrrpData:
     if_name: str
     group: int
     priority: int
     preempt: bool
     master: bool
-    ip:IPv4Address
+    ip:int
     raw_data:Dict
 
+    @property
+    def ipv4(self) -> IPv4Address:
+        return IPv4Address(self.ip)
+
 # CLASS TLOC
-@dataclass
+@dataclass(slots=True)
 class TlocData:
     site_id: int
-    system_ip: IPv4Address
-    private_ip: IPv4Address
-    public_ip: IPv4Address
+    system_ip: int
+    private_ip: int
+    public_ip: int
     preference: int
     weight: int
     encapsulation: str
     color:str
     raw_data:Dict
 
+    @property
+    def system_ipv4(self) -> IPv4Address:
+        return IPv4Address(self.system_ip)
+
+    @property
+    def private_ipv4(self) -> IPv4Address:
+        return IPv4Address(self.private_ip)
+
+    @property
+    def public_ipv4(self) -> IPv4Address:
+        return IPv4Address(self.public_ip)
+
 # Class definition
 class Vmanage:
     # Class constructor
-    def __init__(self, host:str, username:str , password:str , verify:bool=False, port:int=443, semaphore:int=40, debug:bool=False):
+    def __init__(self, host:str, *, verify:bool=False, port:int=443, semaphore:int=40, proxy:str|None=None, debug:bool=False):
         # Base properties
         self.base_url = 'https://' + host + ":" + str(port)
         self.semaphore = semaphore
         # SSL verify
         self.verify = verify
-        # Login
-        self.connected = self.__login(username,password)
-        if self.connected:
-            self.session = httpx.AsyncClient(verify=verify)
+        # Not logged in until connect()
+        self.connected = False
+        limits = httpx.Limits(max_connections=semaphore, max_keepalive_connections=semaphore, keepalive_expiry=30.0)
+        timeout = httpx.Timeout(connect=5.0, read=None, write=None, pool=None)
+        # Disable Nagle and enable TCP keepalive for many small requests
+        socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        # An explicit transport disables httpx's environment proxies, so resolve HTTPS_PROXY/ALL_PROXY/NO_PROXY here
+        if proxy is None and not proxy_bypass(host):
+            proxies = getproxies()
+            proxy = proxies.get("https") or proxies.get("all")
+        # Like httpx, accept scheme-less proxy values such as "proxy:3128"
+        if proxy and "://" not in proxy:
+            proxy = "http://" + proxy
+        # The transport owns verify/http2/limits/proxy once it is passed to the client
+        transport = httpx.AsyncHTTPTransport(verify=verify, http2=True, limits=limits, proxy=proxy, retries=0, socket_options=socket_options)
+        self.session = httpx.AsyncClient(transport=transport, timeout=timeout)
+
+    # Async factory
+    @classmethod
+    async def connect(cls, host:str, username:str, password:str, verify:bool=False, port:int=443, semaphore:int=40, debug:bool=False, proxy:str|None=None) -> "Vmanage":
+        """
+        Creates a session and authenticates to vManage
+        Proxy defaults to the HTTPS_PROXY/ALL_PROXY environment variables, honoring NO_PROXY
+        """
+        session = cls(host, verify=verify, port=port, semaphore=semaphore, proxy=proxy, debug=debug)
+        try:
+            session.connected = await session.__login(username,password)
+        except BaseException:
+            await session.session.aclose()
+            raise
+        if not session.connected:
+            await session.session.aclose()
+        return session
+
+    # Opt-in re-entrant event loop (Jupyter)
+    @staticmethod
+    def enable_nested_loops() -> bool:
+        """
+        Patches asyncio to allow nested run_until_complete calls
+        Only needed in environments that already run a loop, such as Jupyter
+        Skipped under uvloop, which nest_asyncio cannot patch
+        """
+        try:
+            # uvloop.run() does not install a policy, check the running loop first
+            loop_type = type(asyncio.get_running_loop())
+        except RuntimeError:
+            loop_type = type(asyncio.get_event_loop_policy())
+        if loop_type.__module__.startswith("uvloop"):
+            return False
+        import nest_asyncio
+        nest_asyncio.apply()
+        return True
+
+    # Shared semaphore, created on first use so that it binds to the running loop
+    @cached_property
+    def _sem(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.semaphore)
 
     # Login method
-    def __login(self, username:str, password:str) -> bool:
+    async def __login(self, username:str, password:str) -> bool:
         """
         Authenticates to vManage and update session
+        Uses the async session so that its connection is reused afterwards
         """
-        # Create HTTPX client
-        client = httpx.Client(verify=self.verify)
         # Submit login form
         headers = { "Content-Type": "application/x-www-form-urlencoded" }
-        data = { "j_username": f"{username}", "j_password": f"{password}" }
+        data = urlencode({ "j_username": f"{username}", "j_password": f"{password}" })
         try:
-            response = client.post(f"{self.base_url}/j_security_check", data=data, headers=headers)
+            response = await self.session.post(f"{self.base_url}/j_security_check", content=data, headers=headers)
         except httpx.HTTPError as e:
             raise ConnectionError(f'ConnectionError: {e}')
         # Login OK when response code is 200 AND content is not HTML
-        if response.status_code == 200 and not response.text.startswith('<html>'):
+        if response.status_code == 200 and not response.content.startswith(b'<html>'):
             # Get session cookie
             cookie = response.headers.get('Set-Cookie').split(";")[0]
-            # Set headers
+            # Set headers once on the client, every later request inherits them
             self.headers = {
                 "Content-Type": "application/json",
                 "Cookie" : cookie
             }
+            self.session.headers.update(self.headers)
             # Get CSRF token
             try:
-                response = client.get(f"{self.base_url}/dataservice/client/token", headers=self.headers)
+                response = await self.session.get(f"{self.base_url}/dataservice/client/token")
             except httpx.HTTPError as e:
                 raise ConnectionError(f'ConnectionError: {e}')    
             if response.status_code == 200:
                 # Add CSRF header
-                self.headers["X-XSRF-TOKEN"] = response.text
+                self.headers["X-XSRF-TOKEN"] = self.session.headers["X-XSRF-TOKEN"] = response.text
                 # Update base path
                 self.base_url = self.base_url + "/dataservice"
                 return True
@@ -120,156 +235,172 @@ class Vmanage:
         return False
 
     # Private method
-    async def __get(self,path:str,params:dict={}) -> str:
+    async def __get(self,path:str,params:dict={}) -> bytearray:
         """
         Generic GET request
+        Streams the body into a single buffer to avoid holding chunks and their joined copy
         """
         if not self.connected:
             return None
         try:
-            response = await self.session.get(f"{self.base_url}{path}", headers=self.headers, params=params, timeout=None)
+            async with self.session.stream("GET", f"{self.base_url}{path}", params=params) as response:
+                if response.status_code != 200:
+                    return None
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
         except httpx.HTTPError as e:
             raise ConnectionError(f'ConnectionError: {e}')
-        return response.text if response.status_code == 200 else None
+        return buffer
 
     # Private method
-    async def __post(self,path:str,params:dict={},data:dict={}) -> str:
+    async def __post(self,path:str,params:dict={},data:dict={}) -> bytes:
         """
         Generic POST request
         """
         if not self.connected:
             return None
         try:
-            response = await self.session.post(f"{self.base_url}{path}", headers=self.headers, params=params, data=json.dumps(data),timeout=None)
+            response = await self.session.post(f"{self.base_url}{path}", params=params, content=orjson.dumps(data))
         except httpx.HTTPError as e:
             raise ConnectionError(f'ConnectionError: {e}')
-        return response.text if response.status_code == 200 else None
+        return response.content if response.status_code == 200 else None
 
     # Public method
     async def get(self,endpoint:str,params:dict={}) -> dict:
         response = await self.__get(endpoint,params=params)
-        return json.loads(response)['data'] if response and 'data' in response else None
+        if not response:
+            return None
+        # Non-JSON bodies, e.g. the HTML login page once the session expired
+        try:
+            parsed = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(parsed, dict):
+            return None
+        return parsed.get('data')
 
     # Public method
     async def post(self,endpoint:str,params:dict={},data:dict={}) -> dict:
         response = await self.__post(endpoint,params=params,data=data)
-        return json.loads(response)['data'] if response else None
+        if not response:
+            return None
+        try:
+            parsed = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            return None
+        return parsed['data']
 
     # Concurrent GET
     async def get_all(self,tasks) -> list[any]:
-        semaphore = asyncio.Semaphore(self.semaphore)
-        async def sem_task(task):
+        held = _held_sems.get()
+        # Nested call under one of our permits: waiting on the shared semaphore could deadlock,
+        # so bound this call with its own semaphore instead
+        semaphore = asyncio.Semaphore(self.semaphore) if self._sem in held else self._sem
+        async def _wrap(task):
             async with semaphore:
+                _held_sems.set(held | {self._sem})
                 return await task
-        return await asyncio.gather(*[sem_task(task) for task in tasks])
+        return await asyncio.gather(*map(_wrap, tasks))
 
     # Get devices
     async def get_devices(self)->Dict[str,DeviceData]:
         # Fetch raw data
-        tasks = [self.get(f"/system/device/controllers"), self.get(f"/system/device/vedges"), self.get("/device")]
-        results = await self.get_all(tasks)
-
-        # Prepare data
-        controllers = { e["uuid"]: e for e in results[0] }
-        vedges = { e["uuid"]: e for e in results[1] }
-        statuses = { e["uuid"]: e for e in results[2] }
+        results = await asyncio.gather(self.get("/system/device/controllers"), self.get("/system/device/vedges"), self.get("/device"))
 
-        # merge data
-        merged = controllers | vedges
-        for e in merged:
-            if e in statuses:
-                merged[e] = merged[e] | statuses[e]
+        # merge data in place, keyed by uuid
+        merged = {}
+        for e in results[0]:
+            merged[e["uuid"]] = e
+        for e in results[1]:
+            merged[e["uuid"]] = e
+        for e in results[2]:
+            d = merged.get(e["uuid"])
+            if d is not None:
+                d.update(e)
 
         # parse merged data
         devices = {}
-        for i, (k,v) in enumerate(merged.items()):
+        for v in merged.values():
+            g = v.get
+            model = m.replace("vedge-", "").replace("cloud", "vbond") if (m := g("deviceModel")) else None
             devices[v["uuid"]] = DeviceData(
                 uuid=v["uuid"],
                 persona=v["personality"],
-                system_ip=IPv4Address(v["system-ip"]) if ("system-ip" in v) else None,
-                hostname=v["host-name"] if ("host-name" in v) else None,
-                site_id=v["site-id"] if ("site-id" in v) else None,
-                model=v["deviceModel"].replace("vedge-", "").replace("cloud", "vbond") if "deviceModel" in v else None,
-                version=v["version"] if "version" in v else None,
-                template_id=v["templateId"] if "templateId" in v else None,
-                template_name=v["template"] if "template" in v else None,
-                is_managed=True if (("managed-by" in v) and (v["managed-by"] != "Unmanaged")) else False,
-                is_valid=True if (v["validity"] == "valid") else False,
-                is_sync=True if "configStatusMessage" in v and v["configStatusMessage"]=="In Sync" else False,
-                is_reachable=True if "reachability" in v and v["reachability"]=="reachable" else False,
-                latitude=v["latitude"] if ("latitude" in v) else 0.0,
-                longitude=v["longitude"] if ("longitude" in v) else 0.0,
+                system_ip=_ip_int(s) if (s := g("system-ip")) else None,
+                hostname=g("host-name"),
+                site_id=g("site-id"),
+                model=model,
+                version=g("version"),
+                template_id=g("templateId"),
+                template_name=g("template"),
+                is_managed=g("managed-by", "Unmanaged") != "Unmanaged",
+                is_valid=g("validity") == "valid",
+                is_sync=g("configStatusMessage") == "In Sync",
+                is_reachable=g("reachability") == "reachable",
+                latitude=g("latitude", 0.0),
+                longitude=g("longitude", 0.0),
                 raw_data=v
             )
         return devices
 
     # Get device interfaces
     async def get_device_interfaces(self,device:DeviceData)->List[InterfaceData]:
-        raw_data = await self.get("/device/interface/synced",{"deviceId":device.system_ip})
+        raw_data = await self.get("/device/interface/synced",{"deviceId":_ip_str(device.system_ip)})
         if not raw_data:
             return None
-        parsed_interfaces = []
-        for raw_interface in raw_data:
-            parsed_interfaces.append(
-                    InterfaceData(
-                    if_name  = raw_interface["ifname"],
-                    if_desc  = raw_interface.get("description","N/A"),
-                    if_type  = raw_interface["interface-type"],
-                    if_mac   = raw_interface["hwaddr"],
-                    vpn_id   = raw_interface["vpn-id"],
-                    ip       = IPv4Address(raw_interface["ip-address"]),
-                    network  = IPv4Network(f'{raw_interface["ip-address"]}/{raw_interface["ipv4-subnet-mask"]}',strict=False),
-                    raw_data = raw_interface
-                )
+        return [
+            InterfaceData(
+                if_name  = raw_interface["ifname"],
+                if_desc  = raw_interface.get("description","N/A"),
+                if_type  = raw_interface["interface-type"],
+                if_mac   = raw_interface["hwaddr"],
+                vpn_id   = raw_interface["vpn-id"],
+                ip       = _ip(raw_interface["ip-address"]),
+                network  = _net(raw_interface["ip-address"], raw_interface["ipv4-subnet-mask"]),
+                raw_data = raw_interface
             )
-        return parsed_interfaces
+            for raw_interface in raw_data
+        ]
 
     # Get device TLOCs
     async def get_device_tlocs(self,device:DeviceData)->List[TlocData]:
-        raw_data = await self.get("/device/omp/tlocs/advertised",{"deviceId":device.system_ip})
+        raw_data = await self.get("/device/omp/tlocs/advertised",{"deviceId":_ip_str(device.system_ip)})
         if not raw_data:
             return None
-        tlocs = []
-        for tloc in raw_data:
-            tlocs.append(
-                TlocData(
-                    site_id=tloc["site-id"],
-                    system_ip=IPv4Address(tloc["ip"]),
-                    private_ip=IPv4Address(tloc["tloc-private-ip"]),
-                    public_ip=IPv4Address(tloc["tloc-public-ip"]),
-                    preference=tloc["preference"],
-                    weight=tloc["weight"],
-                    encapsulation=tloc["encap"],
-                    color=tloc["color"].lower(),
-                    raw_data=tloc
-                )
+        return [
+            TlocData(
+                site_id=tloc["site-id"],
+                system_ip=_ip_int(tloc["ip"]),
+                private_ip=_ip_int(tloc["tloc-private-ip"]),
+                public_ip=_ip_int(tloc["tloc-public-ip"]),
+                preference=tloc["preference"],
+                weight=tloc["weight"],
+                encapsulation=tloc["encap"],
+                color=tloc["color"].lower(),
+                raw_data=tloc
             )
-        return tlocs 
+            for tloc in raw_data
+        ]
 
     # Get device VRRP info
     async def get_device_vrrp(self,device:DeviceData)->List[VrrpData]:
-        raw_data = await self.get("/device/vrrp",{"deviceId":device.system_ip})
+        raw_data = await self.get("/device/vrrp",{"deviceId":_ip_str(device.system_ip)})
         #print(raw_data)
         if not raw_data:
             return None
-        vips = []
-        for vip in raw_data:
-            if (vip["vrrp-state"] == "proto-state-master"):
-                master = True
-            else:
-                master = False
-            vips.append(
-                VrrpData(
-                    if_name=vip["if-name"],
-                    ip=IPv4Address(vip["virtual-ip"]),
-                    group=vip["group-id"],
-                    priority=vip["priority"],
-                    preempt=vip["preempt"],
-                    master=master,
-                    raw_data=vip
-                )
+        return [
+            VrrpData(
+                if_name=vip["if-name"],
+                ip=_ip_int(vip["virtual-ip"]),
+                group=vip["group-id"],
+                priority=vip["priority"],
+                preempt=vip["preempt"],
+                master=vip["vrrp-state"] == "proto-state-master",
+                raw_data=vip
             )
-        return vips
+            for vip in raw_data
+        ]
 
     # Get device template values
     async def get_device_template_values(self,device:DeviceData)->Dict: